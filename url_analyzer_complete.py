@@ -1,9 +1,22 @@
 import streamlit as st
-from urllib.parse import urlparse
 import requests
-from xml.etree import ElementTree as ET
-from collections import defaultdict, OrderedDict
-import csv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from lxml import etree as ET
+    LXML_AVAILABLE = True
+except ImportError:
+    from xml.etree import ElementTree as ET
+    LXML_AVAILABLE = False
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import codecs
+import hashlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
 import io
 
 st.set_page_config(
@@ -30,95 +43,313 @@ st.markdown("""
         font-size: 0.95rem;
         opacity: 0.9;
     }
+    .metric-grid {
+        display: grid;
+        grid-template-columns: repeat(4, 1fr);
+        gap: 1rem;
+        margin-bottom: 1rem;
+    }
+    .metric-box {
+        background: rgba(102, 126, 234, 0.08);
+        border-left: 4px solid #667eea;
+        border-radius: 10px;
+        padding: 1rem;
+    }
+    .metric-value {
+        font-size: 1.75rem;
+        font-weight: bold;
+    }
+    .metric-label {
+        font-size: 0.85rem;
+        opacity: 0.7;
+    }
 </style>
+<div class="header-container">
+    <div class="header-title">🔗 URL Directory Analyzer</div>
+    <div class="header-subtitle">Sube tu CSV de Screaming Frog o analiza un sitemap XML</div>
+</div>
 """, unsafe_allow_html=True)
 
-def parse_url_structure(url):
-    try:
-        parsed = urlparse(url)
-        domain = f"{parsed.scheme}://{parsed.netloc}"
-        path = parsed.path if parsed.path else "/"
-        parts = [p for p in path.split('/') if p]
-        return domain, path, parts
-    except:
-        return None, None, []
-
-def get_subdomain(url):
-    try:
-        return urlparse(url).netloc
-    except:
-        return None
+CODE_COLUMN = 'Código de respuesta'
+METRIC_COLUMNS = {'sessions': 'GA4 Sessions', 'clics': 'Clics', 'impresiones': 'Impresiones'}
+DISPLAY_COLUMNS = ['Dirección', 'GA4 Sessions', 'GA4 Views', 'Clics', 'Impresiones', 'Código de respuesta', 'H1-1']
+METRIC_LABELS = {'urls': 'URLs', 'sessions': 'Sesiones GA4', 'clics': 'Clics', 'impresiones': 'Impresiones'}
+URL_PATTERN = r'(?i)^(?P<scheme>https?)://(?P<netloc>[^/?#]+)(?:/+(?P<first>[^/?#]*))?'
+DIRECTORY_LABEL = "{} ({} URLs)".format
+DIRECTORY_SESSIONS_LABEL = "{} ({} URLs · {} sesiones)".format
+METRIC_BOX = '<div class="metric-box"><div class="metric-value">{}</div><div class="metric-label">{}</div></div>'.format
+MAX_ROWS_PER_DIRECTORY = 1000
+SITEMAP_WORKERS = 16
+SITEMAP_TTL = 3600
+DATA_CACHE_ENTRIES = 8
+DATA_CACHE_TTL = 3600
+MAX_TOP_DIRECTORIES = 100
+# Un render pide hasta MAX_TOP_DIRECTORIES + 2 CSV (todas, raíz y directorios):
+# caben varios renders completos antes de que el LRU empiece a desalojar
+CSV_CACHE_ENTRIES = 4 * (MAX_TOP_DIRECTORIES + 2)
+CSV_CACHE_TTL = 3600
 
-def calculate_metrics(rows_list):
-    if not rows_list:
-        return {'urls': 0, 'sessions': 0, 'clics': 0, 'impresiones': 0}
+# Sesión HTTP compartida: reutiliza conexiones y reintenta errores transitorios
+HTTP_SESSION = requests.Session()
+for prefix in ('https://', 'http://'):
+    HTTP_SESSION.mount(prefix, HTTPAdapter(pool_maxsize=SITEMAP_WORKERS, max_retries=Retry(total=3, backoff_factor=0.3)))
+
+def detect_encoding(raw):
+    # pyarrow no falla con bytes que no son UTF-8, así que se comprueba antes
     try:
-        sessions = sum(int(float(row.get('GA4 Sessions', 0) or 0)) for row in rows_list)
-        clics = sum(int(float(row.get('Clics', 0) or 0)) for row in rows_list)
-        impresiones = sum(int(float(row.get('Impresiones', 0) or 0)) for row in rows_list)
-    except:
-        sessions = clics = impresiones = 0
-    return {'urls': len(rows_list), 'sessions': sessions, 'clics': clics, 'impresiones': impresiones}
-
-def format_number(num):
-    if num >= 1_000_000:
-        return f"{num/1_000_000:.1f}M"
-    elif num >= 1_000:
-        return f"{num/1_000:.1f}K"
-    return str(int(num))
+        raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf8'
 
-st.markdown("""
-<div class="header-container">
-    <div class="header-title">🔗 URL Directory Analyzer</div>
-    <div class="header-subtitle">Sube tu CSV de Screaming Frog</div>
-</div>
-""", unsafe_allow_html=True)
+@st.cache_resource(max_entries=DATA_CACHE_ENTRIES, ttl=DATA_CACHE_TTL)
+def load_csv_file(data_id, _raw):
+    # data_id es el MD5 de _raw: los bytes no se vuelven a hashear para la caché
+    read_options = pa_csv.ReadOptions(block_size=8 << 20, encoding=detect_encoding(_raw))
+    df = pa_csv.read_csv(io.BytesIO(_raw), read_options=read_options).to_pandas(types_mapper=pd.ArrowDtype)
+    # Convierte las métricas a enteros una sola vez al cargar
+    for col in METRIC_COLUMNS.values():
+        if col in df:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64').fillna(0).astype('int64')
+    if CODE_COLUMN in df:
+        df[CODE_COLUMN] = pd.to_numeric(df[CODE_COLUMN], errors='coerce').astype('Int32')
+    return annotate_rows(df)
+
+def iter_sitemap_locs(source):
+    # Devuelve (etiqueta, loc) por cada <url>/<sitemap> sin construir el árbol completo
+    if LXML_AVAILABLE:
+        for _, elem in ET.iterparse(source, tag=('{*}url', '{*}sitemap'), recover=True, resolve_entities=False, no_network=True):
+            yield elem.tag.rpartition('}')[2], (elem.findtext('{*}loc') or '').strip()
+            # Libera el elemento y los hermanos ya procesados que cuelgan de la raíz
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+    # Solo cuenta el <loc> hijo directo de <url>/<sitemap>: las extensiones
+    # (image:loc, video:...) van anidadas más abajo
+    root = loc = None
+    depth = 0
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        tag = elem.tag.rpartition('}')[2]
+        if depth == 2 and tag == 'loc':
+            loc = (elem.text or '').strip()
+        elif depth == 1 and tag in ('url', 'sitemap'):
+            yield tag, loc
+            loc = None
+            root.clear()
+
+def parse_sitemap(sitemap_url):
+    urls, child_sitemaps = [], []
+    with HTTP_SESSION.get(sitemap_url, stream=True, timeout=10) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for tag, loc in iter_sitemap_locs(response.raw):
+            if loc:
+                (urls if tag == 'url' else child_sitemaps).append(loc)
+    return urls, child_sitemaps
+
+def read_sitemap(sitemap_url):
+    urls, child_sitemaps = parse_sitemap(sitemap_url)
+    # Índice de sitemaps: los hijos se descargan en paralelo. Según el
+    # protocolo los índices no se anidan, así que solo se expande un nivel
+    # y los <sitemap> que aparezcan en los hijos se ignoran
+    seen = {sitemap_url}
+    child_sitemaps = [url for url in child_sitemaps if not (url in seen or seen.add(url))]
+    if child_sitemaps:
+        with ThreadPoolExecutor(max_workers=SITEMAP_WORKERS) as executor:
+            urls.extend(chain.from_iterable(child_urls for child_urls, _ in executor.map(parse_sitemap, child_sitemaps)))
+    return urls
+
+@st.cache_resource(max_entries=DATA_CACHE_ENTRIES, ttl=SITEMAP_TTL)
+def load_sitemap(sitemap_url):
+    # El identificador sale del contenido: si el sitemap cambia al expirar
+    # el TTL, las cachés que dependen de data_id no reutilizan datos viejos
+    urls = read_sitemap(sitemap_url)
+    data_id = hashlib.md5('\n'.join(urls).encode()).hexdigest()
+    return data_id, annotate_rows(pd.DataFrame({'Dirección': urls}))
+
+def annotate_rows(df):
+    # Quita espacios alrededor de la URL y descarta filas vacías
+    df['Dirección'] = pd.arrays.ArrowExtensionArray(pc.utf8_trim_whitespace(pc.cast(pa.array(df['Dirección']), pa.string())))
+    valid = df['Dirección'].notna() & (df['Dirección'] != '')
+    if not valid.all():
+        df = df.loc[valid].copy()
+    # Extrae host y primer directorio de todas las URLs con una única
+    # expresión regular vectorizada
+    parts = pc.extract_regex(pa.array(df['Dirección'], type=pa.string()), URL_PATTERN)
+    df['_netloc'] = pd.arrays.ArrowExtensionArray(pc.struct_field(parts, 'netloc')).astype('category')
+    # Clave de directorio: "/<primer segmento>", o "/" para URLs en la raíz
+    df['_key'] = pd.arrays.ArrowExtensionArray(pc.binary_join_element_wise('/', pc.struct_field(parts, 'first'), ''))
+    return df
+
+@st.cache_data(max_entries=DATA_CACHE_ENTRIES, ttl=DATA_CACHE_TTL)
+def enumerate_filters(data_id, _df):
+    # Subdominios y códigos de respuesta, con su número de URLs. _netloc es
+    # categórica con las categorías ya ordenadas, así que basta con contar
+    # en ese orden sin reordenar
+    subdomain_counts = _df['_netloc'].value_counts(sort=False)
+    code_counts = _df[CODE_COLUMN].value_counts(sort=False).sort_index() if CODE_COLUMN in _df else pd.Series(dtype='int64')
+    return subdomain_counts.to_dict(), code_counts.to_dict()
+
+def calculate_metrics(df, has_metrics=True):
+    if not has_metrics:
+        return {'urls': len(df), 'sessions': 0, 'clics': 0, 'impresiones': 0}
+    # Una sola reducción sobre las columnas de métricas presentes
+    totals = df[[col for col in METRIC_COLUMNS.values() if col in df]].sum()
+    metrics = {'urls': len(df)}
+    for key, col in METRIC_COLUMNS.items():
+        metrics[key] = int(totals.get(col, 0))
+    return metrics
+
+@st.cache_data(max_entries=DATA_CACHE_ENTRIES, ttl=DATA_CACHE_TTL)
+def build_directory_structure(data_id, filter_codes, subdomain, _df):
+    # Agrega las métricas de todos los directorios en una sola pasada y
+    # devuelve, por directorio, las posiciones de sus filas en _df.
+    # _df son las filas fuera de la raíz tras aplicar (filter_codes, subdomain) a data_id.
+    # La clave se factoriza a enteros: un argsort agrupa las filas y las
+    # sumas salen de reduceat sobre los tramos contiguos.
+    codes, uniques = pd.factorize(_df['_key'])
+    order = np.argsort(codes, kind='stable')
+    order = order[np.count_nonzero(codes < 0):]  # claves nulas (código -1)
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    structure = pd.DataFrame({'urls': np.diff(np.append(starts, len(order)))}, index=pd.Index(uniques, name='_key'))
+    for key, col in METRIC_COLUMNS.items():
+        if col in _df and len(order):
+            structure[key] = np.add.reduceat(_df[col].to_numpy()[order], starts)
+        else:
+            structure[key] = 0
+    dir_rows = dict(zip(uniques, np.split(order, starts[1:])))
+    # Sin sesiones (p. ej. un sitemap) se ordena por número de URLs
+    sort_key = 'sessions' if METRIC_COLUMNS['sessions'] in _df else 'urls'
+    return structure.sort_values(sort_key, ascending=False, kind='stable'), dir_rows
+
+@st.cache_data(max_entries=CSV_CACHE_ENTRIES, ttl=CSV_CACHE_TTL, show_spinner=False)
+def to_csv_bytes(cache_key, columns, _df, _rows=None):
+    # cache_key identifica el subconjunto (fuente, filtros, directorio); las
+    # filas solo se materializan y codifican la primera vez
+    if _rows is not None:
+        _df = _df.iloc[_rows]
+    _df = _df[list(columns)]
+    table = pa.Table.from_pandas(_df, preserve_index=False)
+    sink = io.BytesIO()
+    pa_csv.write_csv(table, sink)
+    # BOM para que Excel detecte UTF-8, como hacía to_csv(encoding='utf-8-sig')
+    return codecs.BOM_UTF8 + sink.getvalue()
+
+def format_numbers(values):
+    # Formatea todo el array de una vez: 1.2K, 3.4M...
+    values = np.asarray(values, dtype='float64')
+    return np.select(
+        [values >= 1_000_000, values >= 1_000],
+        [np.char.mod('%.1fM', values / 1_000_000), np.char.mod('%.1fK', values / 1_000)],
+        default=np.char.mod('%d', values)
+    ).tolist()
 
 uploaded_file = st.file_uploader("Sube tu CSV", type=['csv'])
+sitemap_url = st.text_input("O introduce la URL de un sitemap XML")
 
-if uploaded_file:
+if uploaded_file or sitemap_url:
     try:
-        content = uploaded_file.read().decode('utf-8-sig')
-        reader = csv.DictReader(io.StringIO(content))
-        data = list(reader)
+        if uploaded_file:
+            raw = uploaded_file.getvalue()
+            data_id = hashlib.md5(raw).hexdigest()
+            data = load_csv_file(data_id, raw)
+        else:
+            data_id, data = load_sitemap(sitemap_url)
+        columns = [col for col in data.columns if not col.startswith('_')]
+        # Las tablas solo envían al navegador las columnas de DISPLAY_COLUMNS presentes
+        display_columns = [col for col in DISPLAY_COLUMNS if col in data] or columns
+        has_metrics = any(col in data for col in METRIC_COLUMNS.values())
         
         st.success(f"✅ Cargadas {len(data)} URLs")
+        unparsed = data['_netloc'].isna().sum()
+        if unparsed:
+            st.warning(f"⚠️ {unparsed} URLs no son http(s) válidas y no aparecen en filtros, métricas ni tablas")
         
-        # Filtro de subdominios
-        subdomains = sorted(list(set(get_subdomain(row['Dirección']) for row in data if row.get('Dirección'))))
-        selected_subdomain = st.selectbox("Subdominio", subdomains)
+        # Filtros de subdominio y código de respuesta
+        subdomain_counts, code_counts = enumerate_filters(data_id, data)
+        selected_subdomain = st.selectbox("Subdominio", list(subdomain_counts), format_func=lambda s: f"{s} ({subdomain_counts[s]})")
+        selected_codes = st.multiselect("Código de respuesta", list(code_counts), format_func=lambda c: f"{c} ({code_counts[c]})") if code_counts else []
         
-        # Filtrar
-        filtered_data = [row for row in data if get_subdomain(row['Dirección']) == selected_subdomain]
+        # Filtrar con una única máscara; el filtro de códigos solo se evalúa si hay selección
+        mask = data['_netloc'] == selected_subdomain
+        if selected_codes:
+            mask &= data[CODE_COLUMN].isin(pd.array(selected_codes, dtype='Int32'))
+        filtered_data = data.loc[mask]
+        filter_key = (data_id, tuple(sorted(selected_codes)), selected_subdomain)
         
         # Métricas
         st.markdown("### 📊 Resumen")
-        metrics = calculate_metrics(filtered_data)
-        col1, col2, col3, col4 = st.columns(4)
-        with col1:
-            st.metric("Total URLs", format_number(metrics['urls']))
-        with col2:
-            st.metric("Sesiones GA4", format_number(metrics['sessions']))
-        with col3:
-            st.metric("Clics", format_number(metrics['clics']))
-        with col4:
-            st.metric("Impresiones", format_number(metrics['impresiones']))
+        metrics = calculate_metrics(filtered_data, has_metrics)
+        metric_keys = ['urls', *METRIC_COLUMNS] if has_metrics else ['urls']
+        metric_values = format_numbers([metrics[key] for key in metric_keys])
+        metric_boxes = [METRIC_BOX(value, "Total URLs" if key == 'urls' else METRIC_LABELS[key]) for key, value in zip(metric_keys, metric_values)]
+        st.markdown(f'<div class="metric-grid">{"".join(metric_boxes)}</div>', unsafe_allow_html=True)
+        export_all_columns = st.toggle("Exportar todas las columnas", value=True)
+        export_columns = tuple(columns if export_all_columns else display_columns)
+        st.download_button(
+            "📥 Descargar todas las URLs",
+            to_csv_bytes((*filter_key, None), export_columns, filtered_data),
+            file_name="urls.csv",
+            mime='text/csv',
+            key="download_all"
+        )
+        
+        # URLs en raíz (sin directorio)
+        # Raíz y directorios salen de una sola máscara: dos frames disjuntos
+        non_root_mask = filtered_data['_key'] != '/'
+        root_urls = filtered_data.loc[~non_root_mask]
+        if not root_urls.empty:
+            st.markdown("### 🏠 URLs en Raíz")
+            with st.expander(DIRECTORY_LABEL('/', len(root_urls))):
+                st.dataframe(root_urls.head(MAX_ROWS_PER_DIRECTORY)[display_columns], use_container_width=True, hide_index=True)
+                st.download_button(
+                    "📥 Descargar CSV",
+                    to_csv_bytes((*filter_key, '/'), export_columns, root_urls),
+                    file_name="raiz.csv",
+                    mime='text/csv',
+                    key="download_root"
+                )
         
         # Directorios
         st.markdown("### 📁 Directorios")
-        dir_structure = defaultdict(list)
-        for row in filtered_data:
-            url = row.get('Dirección', '')
-            domain, path, parts = parse_url_structure(url)
-            if parts:
-                dir_key = f"/{parts[0]}"
-                dir_structure[dir_key].append(row)
+        dir_data = filtered_data.loc[non_root_mask]
+        dir_structure, dir_rows = build_directory_structure(*filter_key, dir_data)
+        top_n = st.number_input("Directorios a mostrar", min_value=1, max_value=MAX_TOP_DIRECTORIES, value=20, step=1)
+        top_dirs = dir_structure.iloc[:top_n]
+        if has_metrics:
+            labels = [DIRECTORY_SESSIONS_LABEL(*values) for values in zip(top_dirs.index, top_dirs['urls'], format_numbers(top_dirs['sessions']))]
+        else:
+            labels = [DIRECTORY_LABEL(directory, count) for directory, count in zip(top_dirs.index, top_dirs['urls'])]
+        for directory, label in zip(top_dirs.index, labels):
+            with st.expander(label):
+                # Solo se construyen las filas visibles; el CSV completo sale de caché
+                rows = dir_rows[directory]
+                st.dataframe(dir_data.iloc[rows[:MAX_ROWS_PER_DIRECTORY]][display_columns], use_container_width=True, hide_index=True)
+                if len(rows) > MAX_ROWS_PER_DIRECTORY:
+                    st.caption(f"Mostrando {MAX_ROWS_PER_DIRECTORY} de {len(rows)} URLs")
+                st.download_button(
+                    "📥 Descargar CSV",
+                    to_csv_bytes((*filter_key, directory), export_columns, dir_data, rows),
+                    file_name=f"{directory.strip('/')}.csv",
+                    mime='text/csv',
+                    key=f"download_{directory}"
+                )
         
-        for directory in sorted(dir_structure.keys()):
-            urls = dir_structure[directory]
-            metrics = calculate_metrics(urls)
-            with st.expander(f"{directory} ({metrics['urls']} URLs)"):
-                st.dataframe(urls, use_container_width=True, hide_index=True)
+        # Resto de directorios: solo la fila de resumen
+        other_dirs = dir_structure.iloc[top_n:]
+        if not other_dirs.empty:
+            st.caption(f"Otros {len(other_dirs)} directorios")
+            st.dataframe(
+                other_dirs.rename_axis('Directorio').rename(columns=METRIC_LABELS),
+                use_container_width=True
+            )
                 
     except Exception as e:
         st.error(f"Error: {str(e)}")